@@ -2,143 +2,345 @@
 """Get Release Stats
 
 Get statistics for different Bitcoin Core releases."""
-from collections import defaultdict
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import configparser
 import csv
+import fnmatch
+import hashlib
+import itertools
 import json
 import os
+import pygit2
+import random
+import re
 import requests
-import subprocess
+import tempfile
 import time
 
+# On-disk cache of git history stats and github responses. Set RELEASE_STATS_NO_CACHE=1 to ignore existing entries.
+CACHE_DIR = os.path.expanduser("~/.cache/bitcoin-release-stats")
+NO_CACHE = bool(os.environ.get("RELEASE_STATS_NO_CACHE"))
+# Subdirectory for stats derived from git history. Bump it when the way they're computed changes.
+HISTORY_CACHE = "history-v2"
+
+# Concurrent github requests. Kept low to stay clear of github's secondary rate limits.
+MAX_WORKERS = 16
+
+# Subject of a PR merge commit made by github-merge.py. Matched against the raw message bytes to skip decoding.
+# Reverts ("Revert "Merge #...") don't match because of the anchor.
+MERGE_RE = re.compile(rb'^Merge #(\d+):')
+
+# Maximum page size for github's REST API
+PER_PAGE = 100
+
+# Idempotent github GETs whose parsed bodies are reused for the rest of the run
+MEMOIZED_REQUESTS = ['repos/*/pulls/*/comments', 'repos/*/issues/*/comments']
+
+# Merged PRs are filtered server-side, so only the fields we use are transferred.
+PRS_QUERY = """
+query($cursor: String) {
+  repository(owner: "bitcoin", name: "bitcoin") {
+    pullRequests(states: MERGED, baseRefName: "master", first: 100, after: $cursor) {
+      pageInfo { endCursor hasNextPage }
+      nodes { number author { login } createdAt mergedAt baseRefName }
+    }
+  }
+}
+"""
+
+def retry_delay(resp, attempt):
+    """Returns how long to wait before retrying a failed github request.
+
+    Honours Retry-After and the primary rate limit reset time if github sent them. Otherwise (5xx, 429, or a 403 from
+    the secondary rate limit or a permission error) backs off exponentially with jitter."""
+    if 'Retry-After' in resp.headers:
+        return int(resp.headers['Retry-After'])
+    # Checked whatever the status, since GraphQL reports rate limiting with a 200
+    if resp.headers.get('X-RateLimit-Remaining') == '0':
+        return max(0, int(resp.headers['X-RateLimit-Reset']) - time.time())
+    return min(60, 2 ** attempt) + random.random()
+
 # TODO: don't use the github API for requesting PRs, comments, etc. Use the bitcoin-gh-meta data dump. It's much faster.
 class Github():
     # Handles requests to the github API
 
-    def __init__(self, client_id, client_secret):
-        self.client_id = client_id
-        self.client_secret = client_secret
+    def __init__(self, token):
+        # Share one session between threads so connections are reused. The default pool only keeps 10 connections,
+        # so size it to the number of worker threads.
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_WORKERS))
+        self.session.headers.update({
+            'Authorization': 'Bearer {}'.format(token),
+            'Accept': 'application/vnd.github+json',
+            'X-GitHub-Api-Version': '2022-11-28',
+        })
+        self.memo = {}
+        # X-RateLimit-Remaining from the latest response. Only recorded here, so the worker threads don't print.
+        self.rate_limit_remaining = None
 
-    def request(self, req, options=None):
+    def request(self, req, options=None, headers=None):
         """makes request to the github API."""
         if options is None:
             options = []
         uri = "https://api.github.com/{}".format(req)
+        if options:
+            uri += "?" + "&".join(options)
+
+        resp = self.session.get(uri, headers=headers)
+        self.rate_limit_remaining = resp.headers.get('X-RateLimit-Remaining', self.rate_limit_remaining)
+        return resp
 
-        return requests.get(uri, auth=(self.client_id, self.client_secret))
+    def cached_get(self, req, options=None):
+        """GETs req, revalidating the copy cached on disk with its ETag.
 
-    def get_prs(self, page):
+        A 304 response costs no download and doesn't count against the rate limit. Rate limited and server errors
+        are retried; raises requests.HTTPError if the request still fails."""
+        if options is None:
+            options = []
+        key = (req, tuple(sorted(options)))
+        memoize = any(fnmatch.fnmatchcase(req, pattern) for pattern in MEMOIZED_REQUESTS)
+        if memoize and key in self.memo:
+            return self.memo[key]
+        name = "github/{}.json".format("_".join([req] + options))
+        cached = read_cache(name)
+        headers = {'If-None-Match': cached['etag']} if cached else None
         for i in range(5):
-            resp = self.request('repos/bitcoin/bitcoin/pulls', ["state=closed", "per_page=100", "page={}".format(page)])
-            if resp.status_code == 200:
+            resp = self.request(req, options, headers=headers)
+            if resp.status_code not in (403, 429) and resp.status_code < 500:
                 break
-            time.sleep(1)
-        if resp.status_code != 200:
-            print("Failed to request page {}. Response code {}".format(page, resp.status_code))
-        ret = json.loads(resp.text)
-        print("Page {}. Received {} PRs. First = {}; Last = {}".format(page, len(ret), ret[0]['number'], ret[-1]['number']))
-        return ret
+            if i < 4:
+                time.sleep(retry_delay(resp, i))
+        if resp.status_code == 304:
+            body = cached['body']
+        else:
+            # Don't hand error documents back to the caller as if they were the response body
+            resp.raise_for_status()
+            body = resp.json()
+            if resp.status_code == 200 and 'ETag' in resp.headers:
+                write_cache(name, {'etag': resp.headers['ETag'], 'body': body})
+        if memoize:
+            self.memo[key] = body
+        return body
+
+    def get_comments(self, req):
+        """Get all comments from a paginated comments endpoint, stopping at the first page that isn't full."""
+        comments = []
+        for page in itertools.count(1):
+            batch = self.cached_get(req, ["per_page={}".format(PER_PAGE), "page={}".format(page)])
+            comments += batch
+            if len(batch) < PER_PAGE:
+                break
+        return comments
+
+    def graphql(self, query, variables):
+        """makes a query to the github GraphQL API."""
+        uri = "https://api.github.com/graphql"
+
+        resp = self.session.post(uri, json={"query": query, "variables": variables})
+        self.rate_limit_remaining = resp.headers.get('X-RateLimit-Remaining', self.rate_limit_remaining)
+        return resp
+
+    def get_prs(self):
+        """Get all PRs merged into master, following the GraphQL cursor one page of 100 at a time."""
+        prs = []
+        cursor = None
+        while True:
+            for i in range(5):
+                resp = self.graphql(PRS_QUERY, {"cursor": cursor})
+                result = resp.json() if resp.status_code == 200 else None
+                # GraphQL reports query errors as a 200 with an errors array. Only rate limiting is worth retrying.
+                if result is not None and not any(error.get('type') == 'RATE_LIMITED' for error in result.get('errors', [])):
+                    break
+                if i < 4:
+                    time.sleep(retry_delay(resp, i))
+            if result is None:
+                print("Failed to request PRs after cursor {}. Response code {}".format(cursor, resp.status_code))
+                break
+            if 'errors' in result:
+                print("Failed to request PRs after cursor {}. Errors: {}".format(cursor, "; ".join(error['message'] for error in result['errors'])))
+                break
+            connection = result['data']['repository']['pullRequests']
+            ret = connection['nodes']
+            prs += ret
+            if ret:
+                print("Received {} PRs. First = {}; Last = {}. API rate limit remaining {}".format(len(ret), ret[0]['number'], ret[-1]['number'], self.rate_limit_remaining))
+            if not connection['pageInfo']['hasNextPage']:
+                break
+            cursor = connection['pageInfo']['endCursor']
+        return prs
+
+def read_cache(name):
+    """Returns the json object cached under name, or None on a miss (or if caching is disabled)."""
+    if NO_CACHE:
+        return None
+    try:
+        with open(os.path.join(CACHE_DIR, name), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def write_cache(name, obj):
+    """Atomically writes obj as json under name in the cache directory."""
+    path = os.path.join(CACHE_DIR, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=os.path.dirname(path), delete=False) as f:
+        json.dump(obj, f)
+    os.replace(f.name, path)
+
+def resolve_commit(repo, committish):
+    """Returns the commit id for a branch, tag (including annotated tags) or other committish."""
+    return repo.revparse_single(committish).peel(pygit2.Commit).id
 
-def parse_pr(pr):
-    return f"{pr['number']},{pr['user']['login']},{pr['state']},{pr['created_at']},{pr['closed_at']}"
+def decode_author(raw_name, encoding):
+    """Decodes an author name with its commit's encoding header (utf-8 if unset or unknown), as git log does."""
+    try:
+        return raw_name.decode(encoding or 'utf-8', 'replace')
+    except LookupError:
+        return raw_name.decode('utf-8', 'replace')
+
+def get_range_stats(repo, prev_branch, branch):
+    """Get commit, merge and author stats for prev_branch..branch.
+
+    Merged history is immutable, so the result is cached on disk keyed by the two commit ids."""
+    key = hashlib.sha256("{}..{}".format(prev_branch, branch).encode()).hexdigest()
+    stats = read_cache("{}/commits/{}.json".format(HISTORY_CACHE, key))
+    if stats is not None:
+        return stats
+
+    # Walk prev_branch..branch once, counting non-merge commits per author and PRs merged in the release.
+    # Merge counting is highly dependent on the log message format. TODO: Improve this by using the github API to find out when PRs were merged to master
+    commits = 0
+    merges = 0
+    commits_by_author = Counter()
+    walker = repo.walk(branch)
+    walker.hide(prev_branch)
+    for commit in walker:
+        if len(commit.parent_ids) > 1:
+            if MERGE_RE.match(commit.raw_message):
+                merges += 1
+        else:
+            commits += 1
+            commits_by_author[(commit.author.raw_name, commit.message_encoding)] += 1
+
+    # Names are tallied as raw bytes and only decoded once per (author, encoding)
+    authors = Counter()
+    for (raw_name, encoding), count in commits_by_author.items():
+        authors[decode_author(raw_name, encoding)] += count
+    stats = {
+        'commits': commits,
+        'merges': merges,
+        'authors': sorted(authors),
+        'authors_by_commit': authors.most_common(10),
+    }
+    write_cache("{}/commits/{}.json".format(HISTORY_CACHE, key), stats)
+    return stats
+
+def get_old_authors(repo, merge_base, known):
+    """Get the set of authors of all non-merge commits up to merge_base.
+
+    History below a commit never changes, so this is cached keyed by the merge base alone. On a miss, only the
+    history since the nearest ancestor in known (a dict of merge base to old authors) is walked."""
+    old_authors = read_cache("{}/old_authors/{}.json".format(HISTORY_CACHE, merge_base))
+    if old_authors is not None:
+        return set(old_authors)
+
+    base = None
+    for candidate in known:
+        if repo.descendant_of(merge_base, candidate) and (base is None or repo.descendant_of(candidate, base)):
+            base = candidate
+
+    walker = repo.walk(merge_base)
+    old_authors = set()
+    if base is not None:
+        walker.hide(base)
+        old_authors.update(known[base])
+    raw_authors = set((commit.author.raw_name, commit.message_encoding) for commit in walker if len(commit.parent_ids) <= 1)
+    old_authors.update(decode_author(raw_name, encoding) for raw_name, encoding in raw_authors)
+    write_cache("{}/old_authors/{}.json".format(HISTORY_CACHE, merge_base), sorted(old_authors))
+    return old_authors
 
 def main():
     # Read config file
     config = configparser.ConfigParser()
     configfile = os.path.abspath(os.path.dirname(__file__)) + "/config.ini"
-    config.read_file(open(configfile, encoding="utf8"))
+    with open(configfile, encoding="utf8") as f:
+        config.read_file(f)
 
     bitcoin_dir = config["DEFAULT"]["bitcoin_directory"]
 
-    gh = Github(config["DEFAULT"]["client_id"], config["DEFAULT"]["client_secret"])
-
-    # Check our Github API rate limit
-    rate_limit = gh.request('rate_limit')
-    print("API rate limit stats: {}".format(json.loads(rate_limit.content)['resources']['core']))
-
-    # for page in itertools.count(1):
-    resps = []
-    for page in range(3):
-        resps += gh.get_prs(page)
-        if len(resps) == 0:
-            break
+    gh = Github(config["DEFAULT"]["token"])
 
-    prs = [parse_pr(pr) for pr in resps]
-
-    # PER_PAGE = 100
-    # with multiprocessing.Pool(POOL_WORKERS) as p:
-    #     resps = p.map(gh.get_prs, range(PER_PAGE))
-    #     # assert len(resps[-1]) == 0, "More than 10,000 PRs have been merged. Increase number of requests"
-    #     prs = [pr for prs in resps for pr in prs]
-
-    merged_prs = [pr for pr in prs if pr['merged_at'] is not None and pr['base']['ref'] == 'master']
+    merged_prs = gh.get_prs()
     print([pr['number'] for pr in merged_prs])
 
-    contributors = defaultdict(int)
-    pulls = []
+    contributors = Counter()
     # Read PRs merged in this release
     with open('PRs_15.txt', 'r', encoding='utf-8') as f:
-        for l in f:
-            pulls.append(l.rstrip())
+        pulls = f.read().splitlines()
+
+    repo = pygit2.Repository(bitcoin_dir)
+    master = resolve_commit(repo, "master")
+
+    merge_bases = {release: repo.merge_base(master, resolve_commit(repo, config[release]["previous_branch"])) for release in config.sections()}
+    old_authors_by_base = None
 
     for release in config.sections():
         # Each non-default section in the config file is a new release
-        prev_branch = config[release]["previous_branch"]
-        branch = config[release]["branch"]
-
-        # Get number of non-merge commits in this release
-        commits_cmd = "git -C {} --no-pager log {}..{} --oneline --no-merges | wc -l".format(bitcoin_dir, prev_branch, branch)
-        commits = subprocess.run(commits_cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.rstrip("\n")
-
-        # Get number of PRs merged in the release.
-        # This is highly dependent on the log message format. TODO: Improve this by using the github API to find out when PRs were merged to master
-        merges_cmd = "git -C {} --no-pager log {}..{} --oneline | grep \"Merge #\" | grep -v \"Revert \\\"Merge\" | cut -f 3 -d \" \" | cut -c 2- | cut -f 1 -d \":\" | sort -n | wc -l".format(bitcoin_dir, prev_branch, branch)
-        merges = subprocess.run(merges_cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.rstrip("\n")
-
-        # Get commit authors
-        authors = set()
-        authors_cmd = "git -C {} log {}..{} --no-merges --pretty=format:\"%an\" | sort | uniq".format(bitcoin_dir, prev_branch, branch)
-        authors = set([a for a in subprocess.run(authors_cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.splitlines()])
-        merge_base = subprocess.run("git -C {} merge-base master {}".format(bitcoin_dir, prev_branch), shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.rstrip("\n")
-        old_authors_cmd = "git -C {} log {} --no-merges --pretty=format:\"%an\" | sort | uniq".format(bitcoin_dir, merge_base)
-        old_authors = set([a for a in subprocess.run(old_authors_cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.splitlines()])
-
-        num_new_authors = len(authors.difference(old_authors))
-
-        print("Version {} had {} commits from {} authors ({} new) and {} merges".format(release, commits, len(authors), num_new_authors, merges))
-
-        authors_by_commit_cmd = "git -C {} log {}..{} --no-merges --pretty=format:\"%an\" | sort | uniq -c | sort -n -r".format(bitcoin_dir, prev_branch, branch)
-        authors_by_commit = subprocess.run(authors_by_commit_cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE).stdout.splitlines()[0:10]
-
-        print("Most prolific committers:\n {}".format("\n".join(authors_by_commit)))
-
-    for pr in pulls:
-        print("PR {}".format(pr))
-        # Get PR comments and review comments
-        pr_comments = json.loads(gh.request('repos/bitcoin/bitcoin/issues/{}/comments'.format(pr)).text)
-        review_comments = json.loads(gh.request('repos/bitcoin/bitcoin/pulls/{}/comments'.format(pr)).text)
-        if pr_comments:
-            print("{} pr comments for {}".format(len(pr_comments), pr))
-            for comment in pr_comments:
-                contributors[comment['user']['login']] += 1
-        else:
-            print("no pr comments for {}".format(pr))
-        if review_comments:
-            print("{} review comments for {}".format(len(review_comments), pr))
-            for comment in review_comments:
-                if comment['user'] is not None:
-                    contributors[comment['user']['login']] += 1
-        else:
-            print("no review comments for {}".format(pr))
+        prev_branch = resolve_commit(repo, config[release]["previous_branch"])
+        branch = resolve_commit(repo, config[release]["branch"])
+        merge_base = merge_bases[release]
+
+        # The release summary only depends on these three commits, so skip everything below on a cache hit
+        key = hashlib.sha256("{}..{} {}".format(prev_branch, branch, merge_base).encode()).hexdigest()
+        summary = read_cache("{}/releases/{}.json".format(HISTORY_CACHE, key))
+        if summary is None:
+            if old_authors_by_base is None:
+                # Get authors before each release's merge base, oldest first so each one builds on the last
+                old_authors_by_base = {}
+                for base in sorted(set(merge_bases.values()), key=lambda oid: repo[oid].commit_time):
+                    old_authors_by_base[base] = get_old_authors(repo, base, old_authors_by_base)
+
+            stats = get_range_stats(repo, prev_branch, branch)
+            summary = {
+                'commits': stats['commits'],
+                'merges': stats['merges'],
+                'num_authors': len(stats['authors']),
+                'num_new_authors': len(set(stats['authors']).difference(old_authors_by_base[merge_base])),
+                'authors_by_commit': stats['authors_by_commit'],
+            }
+            write_cache("{}/releases/{}.json".format(HISTORY_CACHE, key), summary)
+
+        print("Version {} had {} commits from {} authors ({} new) and {} merges".format(release, summary['commits'], summary['num_authors'], summary['num_new_authors'], summary['merges']))
+
+        print("Most prolific committers:\n {}".format("\n".join("{:>7} {}".format(count, author) for author, count in summary['authors_by_commit'])))
+
+    # Get PR comments and review comments. Each request is mostly waiting on the network, so run them concurrently.
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {}
+        for pr in pulls:
+            futures[executor.submit(gh.get_comments, 'repos/bitcoin/bitcoin/issues/{}/comments'.format(pr))] = (pr, 'pr')
+            futures[executor.submit(gh.get_comments, 'repos/bitcoin/bitcoin/pulls/{}/comments'.format(pr))] = (pr, 'review')
+        for future in as_completed(futures):
+            pr, kind = futures[future]
+            try:
+                comments = future.result()
+            except requests.RequestException as e:
+                print("Failed to get {} comments for {}: {}".format(kind, pr, e))
+                continue
+            if comments:
+                print("{} {} comments for {}. API rate limit remaining {}".format(len(comments), kind, pr, gh.rate_limit_remaining))
+                contributors.update(comment['user']['login'] for comment in comments if comment.get('user'))
+            else:
+                print("no {} comments for {}. API rate limit remaining {}".format(kind, pr, gh.rate_limit_remaining))
 
     print(contributors)
 
     # Write reviewers/contributors to an output file
-    with open('commenters_15.csv', 'w', encoding='utf-8') as csvfile:
+    with open('commenters_15.csv', 'w', newline='', encoding='utf-8') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(['commenter', 'comments'])
-        for contributor in contributors:
-            writer.writerow([contributor, contributors[contributor]])
+        writer.writerows(contributors.most_common())
 
 if __name__ == '__main__':
     main()